@@ -7,7 +7,6 @@ import pandas as pd
 from datetime import datetime, timedelta
 import random
 import uuid
-from dateutil import parser
 import plotly.express as px
 import plotly.graph_objects as go
 
@@ -206,7 +205,7 @@ with col1:
             pending = count_pending(wd)
             eta = row["eta_iso"]
             # compute basic ETA delta
-            eta_dt = parser.isoparse(eta) if eta else None
+            eta_dt = datetime.fromisoformat(eta.replace("Z", "+00:00")) if eta else None
             eta_str = eta_dt.strftime("%Y-%m-%d %H:%M:%S UTC") if eta_dt else "NA"
             actions, risk, dem = recommended_actions_for_rake(pending)
             display.append({
@@ -4,18 +4,83 @@
 import streamlit as st
 import sqlite3
 import pandas as pd
+import numpy as np
 from datetime import datetime, timedelta
 import random
 import uuid
-from dateutil import parser
+import re
+from collections import Counter
+import threading
+import queue
+from contextlib import contextmanager
 import plotly.express as px
 import plotly.graph_objects as go
 
 DB_FILE = "urms_demo.db"
+READ_POOL_SIZE = 4
+CACHE_TTL = 10  # seconds
+PAGE_SIZE = 50  # rows per page for the rake/assignment/case tables
+SQLITE_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA cache_size=-20000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",  # 256 MB
+)
 
 # ---------- DB helpers ----------
+@st.cache_resource
+def get_conn():
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False, isolation_level="IMMEDIATE")
+    conn.execute("PRAGMA journal_mode=WAL")
+    for pragma in SQLITE_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+@st.cache_resource
+def get_read_pool():
+    pool = queue.Queue()
+    for _ in range(READ_POOL_SIZE):
+        conn = sqlite3.connect(f"file:{DB_FILE}?mode=ro", uri=True, check_same_thread=False)
+        for pragma in SQLITE_PRAGMAS:
+            conn.execute(pragma)
+        pool.put(conn)
+    return pool
+
+@contextmanager
+def ro_conn():
+    pool = get_read_pool()
+    conn = pool.get()
+    try:
+        yield conn
+    finally:
+        pool.put(conn)
+
+@st.cache_resource
+def get_write_lock():
+    return threading.Lock()
+
+@st.cache_resource
+def get_db_state():
+    return {"version": 0}
+
+def db_version():
+    return get_db_state()["version"]
+
+@contextmanager
+def db_write():
+    conn = get_conn()
+    with get_write_lock():
+        with conn:
+            yield conn
+        get_db_state()["version"] += 1
+
+@st.cache_resource
 def init_db():
-    conn = sqlite3.connect(DB_FILE, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+    with get_write_lock():
+        _init_schema(get_conn())
+
+def _init_schema(conn):
     cur = conn.cursor()
     cur.execute("""
       CREATE TABLE IF NOT EXISTS rake_events (
@@ -49,83 +114,92 @@ def init_db():
         details TEXT
       )
     """)
+    # tables are read newest-first one page at a time; index the ORDER BY columns
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_rake_created ON rake_events(created_ts DESC)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_assign_ts ON truck_assignments(created_ts DESC)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_cases_ts ON cases(reported_ts DESC)")
     conn.commit()
-    conn.close()
+    # seed planner stats once; optimize keeps them fresh
+    conn.execute("PRAGMA analysis_limit=400")
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name='sqlite_stat1'").fetchone() is None:
+        conn.execute("ANALYZE")
+    conn.execute("PRAGMA optimize")
 
 def db_insert_rake(rake_id, fnr, current_station, eta_iso, wagon_details, raw=""):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("INSERT OR REPLACE INTO rake_events (rake_id, fnr, created_ts, current_station, eta_iso, wagon_details, raw) VALUES (?,?,?,?,?,?,?)",
-                (rake_id, fnr, datetime.utcnow(), current_station, eta_iso, wagon_details, raw))
-    conn.commit()
-    conn.close()
+    with db_write() as conn:
+        conn.execute("INSERT OR REPLACE INTO rake_events (rake_id, fnr, created_ts, current_station, eta_iso, wagon_details, raw) VALUES (?,?,?,?,?,?,?)",
+                     (rake_id, fnr, datetime.utcnow(), current_station, eta_iso, wagon_details, raw))
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False, max_entries=4)
+def _load_rakes(version, page):
+    with ro_conn() as conn:
+        return pd.read_sql_query("SELECT * FROM rake_events ORDER BY created_ts DESC LIMIT ? OFFSET ?", conn,
+                                 params=(PAGE_SIZE, page * PAGE_SIZE), parse_dates=["created_ts"])
 
-def db_get_rakes():
-    conn = sqlite3.connect(DB_FILE)
-    df = pd.read_sql_query("SELECT * FROM rake_events", conn, parse_dates=["created_ts"])
-    conn.close()
-    return df
+def db_get_rakes(page=0):
+    return _load_rakes(db_version(), page)
 
 def db_get_rake(rake_id):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM rake_events WHERE rake_id=?", (rake_id,))
-    row = cur.fetchone()
-    conn.close()
-    return row
+    with ro_conn() as conn:
+        return conn.execute("SELECT * FROM rake_events WHERE rake_id=?", (rake_id,)).fetchone()
 
 def db_insert_assignment(rake_id, truck_ids, lane_from, reason):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
     task_id = str(uuid.uuid4())
-    cur.execute("INSERT INTO truck_assignments (id, rake_id, truck_ids, lane_from, reason, created_ts) VALUES (?,?,?,?,?,?)",
-                (task_id, rake_id, ",".join(truck_ids), lane_from, reason, datetime.utcnow()))
-    conn.commit()
-    conn.close()
+    with db_write() as conn:
+        conn.execute("INSERT INTO truck_assignments (id, rake_id, truck_ids, lane_from, reason, created_ts) VALUES (?,?,?,?,?,?)",
+                     (task_id, rake_id, ",".join(truck_ids), lane_from, reason, datetime.utcnow()))
     return task_id
 
-def db_get_assignments():
-    conn = sqlite3.connect(DB_FILE)
-    df = pd.read_sql_query("SELECT * FROM truck_assignments", conn, parse_dates=["created_ts"])
-    conn.close()
-    return df
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False, max_entries=4)
+def _load_assignments(version, page):
+    with ro_conn() as conn:
+        return pd.read_sql_query("SELECT * FROM truck_assignments ORDER BY created_ts DESC LIMIT ? OFFSET ?", conn,
+                                 params=(PAGE_SIZE, page * PAGE_SIZE), parse_dates=["created_ts"])
+
+def db_get_assignments(page=0):
+    return _load_assignments(db_version(), page)
 
 def db_insert_case(rake_id, wagon_no, case_type, reported_by, details):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
     case_id = "CASE-" + str(uuid.uuid4())[:8]
-    cur.execute("INSERT INTO cases (case_id, rake_id, wagon_no, case_type, reported_by, reported_ts, details) VALUES (?,?,?,?,?,?,?)",
-                (case_id, rake_id, wagon_no, case_type, reported_by, datetime.utcnow(), details))
-    conn.commit()
-    conn.close()
+    with db_write() as conn:
+        conn.execute("INSERT INTO cases (case_id, rake_id, wagon_no, case_type, reported_by, reported_ts, details) VALUES (?,?,?,?,?,?,?)",
+                     (case_id, rake_id, wagon_no, case_type, reported_by, datetime.utcnow(), details))
     return case_id
 
-def db_get_cases():
-    conn = sqlite3.connect(DB_FILE)
-    df = pd.read_sql_query("SELECT * FROM cases", conn, parse_dates=["reported_ts"])
-    conn.close()
-    return df
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False, max_entries=4)
+def _load_cases(version, page):
+    with ro_conn() as conn:
+        return pd.read_sql_query("SELECT * FROM cases ORDER BY reported_ts DESC LIMIT ? OFFSET ?", conn,
+                                 params=(PAGE_SIZE, page * PAGE_SIZE), parse_dates=["reported_ts"])
+
+def db_get_cases(page=0):
+    return _load_cases(db_version(), page)
 
 # ---------- Domain helpers ----------
+_WAGON_RE = re.compile(r"([^;:]*):([^;]*)")
+
 def parse_wagon_details(text):
-    # stored as "W1:PENDING;W2:UNLOADED"
-    items = []
-    if not text:
-        return items
-    for part in text.split(";"):
-        if ":" in part:
-            wagon, status = part.split(":", 1)
-            items.append({"wagon_no": wagon.strip(), "status": status.strip()})
-    return items
+    # stored as "W1:PENDING;W2:UNLOADED"; one row per wagon
+    pairs = _WAGON_RE.findall(text or "")
+    return pd.DataFrame({
+        "wagon_no": [wagon.strip() for wagon, _ in pairs],
+        "status": [status.strip() for _, status in pairs],
+    }, dtype=str)
 
-def format_wagon_details(items):
-    return ";".join(f"{w['wagon_no']}:{w['status']}" for w in items)
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False, max_entries=32)
+def _load_wagons(version, rake_id):
+    # inspect panel re-renders on every widget change; parse each rake's wagon text once per version
+    with ro_conn() as conn:
+        row = conn.execute("SELECT wagon_details FROM rake_events WHERE rake_id=?", (rake_id,)).fetchone()
+    return parse_wagon_details(row[0] if row else "")
 
-def count_unloaded(wagon_items):
-    return sum(1 for w in wagon_items if w["status"].upper() == "UNLOADED")
+def wagons_df(rake_id):
+    return _load_wagons(db_version(), rake_id)
 
-def count_pending(wagon_items):
-    return sum(1 for w in wagon_items if w["status"].upper() != "UNLOADED")
+def count_statuses(statuses):
+    counts = Counter(status.upper() for status in statuses)
+    unloaded = counts["UNLOADED"]
+    return unloaded, sum(counts.values()) - unloaded
 
 def simple_eta_predict(distance_km, avg_speed_kmph):
     # simple prediction minutes = (distance / speed) * 60
@@ -143,6 +217,12 @@ def compute_d_and_w_risk(pending_wagons):
     else:
         return ("LOW", 0)
 
+def compute_d_and_w_risk_array(pending):
+    p = np.asarray(pending)
+    risk = np.select([p > 30, p > 10], ["HIGH", "MEDIUM"], "LOW")
+    dem = np.where(p > 30, p * 820, np.where(p > 10, p * 490, 0))
+    return risk, dem
+
 def recommended_actions_for_rake(pending):
     risk, dem = compute_d_and_w_risk(pending)
     actions = []
@@ -182,44 +262,38 @@ with col1:
         wagons_count = st.number_input("Number of wagons", min_value=2, max_value=80, value=8)
         # build wagon statuses randomly
         default_unloaded = st.slider("Initial unloaded wagons", 0, int(wagons_count), 1)
-        wagons = []
-        for i in range(1, wagons_count+1):
-            status = "UNLOADED" if i <= default_unloaded else "PENDING"
-            wagons.append({"wagon_no": f"W{i:03d}", "status": status})
+        wagon_details = ";".join(f"W{i:03d}:{'UNLOADED' if i <= default_unloaded else 'PENDING'}" for i in range(1, wagons_count+1))
         eta_in_hours = st.number_input("ETA (hours from now)", min_value=0.0, max_value=72.0, value=6.0)
         submit_sim = st.form_submit_button("Create Rake Event (simulate FOIS)")
     if submit_sim:
         eta_dt = datetime.utcnow() + timedelta(hours=float(eta_in_hours))
-        db_insert_rake(rake_id, fnr, current_station, eta_dt.isoformat(), format_wagon_details(wagons))
-        st.success(f"Rake {rake_id} created with {len(wagons)} wagons; {default_unloaded} unloaded.")
+        db_insert_rake(rake_id, fnr, current_station, eta_dt.isoformat(), wagon_details)
+        st.success(f"Rake {rake_id} created with {wagons_count} wagons; {default_unloaded} unloaded.")
 
     st.markdown("---")
     st.header("Rakes in System")
-    rakes_df = db_get_rakes()
+    rakes_page = st.number_input("Page", min_value=1, value=1, step=1, key="rakes_page") - 1
+    rakes_df = db_get_rakes(rakes_page)
     if rakes_df.empty:
-        st.info("No rakes yet — simulate one above.")
+        st.info("No rakes yet — simulate one above." if rakes_page == 0 else "No rakes on this page.")
     else:
-        display = []
-        for _, row in rakes_df.iterrows():
-            wd = parse_wagon_details(row["wagon_details"])
-            unloaded = count_unloaded(wd)
-            pending = count_pending(wd)
-            eta = row["eta_iso"]
-            # compute basic ETA delta
-            eta_dt = parser.isoparse(eta) if eta else None
-            eta_str = eta_dt.strftime("%Y-%m-%d %H:%M:%S UTC") if eta_dt else "NA"
-            actions, risk, dem = recommended_actions_for_rake(pending)
-            display.append({
-                "rake_id": row["rake_id"],
-                "fnr": row["fnr"],
-                "station": row["current_station"],
-                "unloaded": unloaded,
-                "pending": pending,
-                "eta": eta_str,
-                "d_and_w_risk": risk,
-                "pred_demurrage_inr": dem
-            })
-        st.dataframe(pd.DataFrame(display).sort_values(["d_and_w_risk","pending"], ascending=[False, False]).reset_index(drop=True))
+        # whole-column counts; a leading ";" anchors each "wagon:status" part
+        details = ";" + rakes_df["wagon_details"].fillna("").str.upper()
+        unloaded = details.str.count(r";[^;:]*:\s*UNLOADED\s*(?=;|$)")
+        pending = details.str.count(r";[^;:]*:") - unloaded
+        eta_dt = pd.to_datetime(rakes_df["eta_iso"], utc=True, errors="coerce", format="ISO8601")
+        risk, dem = compute_d_and_w_risk_array(pending)
+        display = pd.DataFrame({
+            "rake_id": rakes_df["rake_id"],
+            "fnr": rakes_df["fnr"],
+            "station": rakes_df["current_station"],
+            "unloaded": unloaded,
+            "pending": pending,
+            "eta": eta_dt.dt.strftime("%Y-%m-%d %H:%M:%S UTC").fillna("NA"),
+            "d_and_w_risk": risk,
+            "pred_demurrage_inr": dem
+        })
+        st.dataframe(display.sort_values(["d_and_w_risk","pending"], ascending=[False, False]).reset_index(drop=True))
 
 with col2:
     st.header("Inspect / Act on a Rake")
@@ -232,12 +306,10 @@ with col2:
             _, fnr, created_ts, station, eta_iso, wagon_details_text, raw = row
             st.subheader(f"Rake {rake_to_view}")
             st.markdown(f"**FNR:** {fnr}  \n**Station:** {station}  \n**ETA:** {eta_iso}")
-            w_items = parse_wagon_details(wagon_details_text)
+            df_w = wagons_df(rake_to_view)
             st.markdown("**Wagons (status)**")
-            df_w = pd.DataFrame(w_items)
             st.table(df_w)
-            unloaded = count_unloaded(w_items)
-            pending = count_pending(w_items)
+            unloaded, pending = count_statuses(df_w["status"])
             st.markdown(f"**Unloaded:** {unloaded}   **Pending:** {pending}")
             actions, risk, dem = recommended_actions_for_rake(pending)
             st.markdown(f"**D&W Risk:** {risk}  •  **Projected Demurrage INR:** {dem}")
@@ -265,7 +337,7 @@ with col2:
 
             st.markdown("----")
             st.subheader("Create Exception / Case")
-            case_wagon = st.selectbox("Wagon No (choose)", [w["wagon_no"] for w in w_items])
+            case_wagon = st.selectbox("Wagon No (choose)", df_w["wagon_no"].tolist())
             case_type = st.selectbox("Case Type", ["SHORTAGE","DAMAGE","MISSING_WAGON","OTHER"])
             reporter = st.text_input("Reported by", value="depot_user_01")
             details = st.text_area("Details", value=f"Auto - recorded at {datetime.utcnow().isoformat()}")
@@ -275,19 +347,21 @@ with col2:
 
 st.markdown("---")
 st.header("Assignments & Cases")
-assign_df = db_get_assignments()
-case_df = db_get_cases()
 c1, c2 = st.columns(2)
 with c1:
     st.subheader("Truck Assignments")
+    assign_page = st.number_input("Page", min_value=1, value=1, step=1, key="assign_page") - 1
+    assign_df = db_get_assignments(assign_page)
     if assign_df.empty:
-        st.info("No assignments yet.")
+        st.info("No assignments yet." if assign_page == 0 else "No assignments on this page.")
     else:
         st.dataframe(assign_df)
 with c2:
     st.subheader("Cases")
+    case_page = st.number_input("Page", min_value=1, value=1, step=1, key="case_page") - 1
+    case_df = db_get_cases(case_page)
     if case_df.empty:
-        st.info("No cases yet.")
+        st.info("No cases yet." if case_page == 0 else "No cases on this page.")
     else:
         st.dataframe(case_df)
 
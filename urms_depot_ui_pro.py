@@ -5,19 +5,141 @@
 import streamlit as st
 import sqlite3
 import pandas as pd
-from datetime import datetime, timedelta
+import numpy as np
+from datetime import datetime, timedelta, timezone
 import random, uuid
-from dateutil import parser
+import json
+import re
+from collections import Counter
+import traceback
+import atexit
+import threading
+import time
+import queue
+from contextlib import contextmanager
 import plotly.express as px
 import plotly.graph_objects as go
 
 DB_FILE = "urms_demo_pro.db"
+READ_POOL_SIZE = 4
+CACHE_TTL = 10  # seconds; bounds staleness from writes made outside this process
+LOG_BATCH_SIZE = 50
+LOG_FLUSH_INTERVAL = 0.1  # seconds
+ACTIVITY_INSERT = "INSERT INTO activity_log (id, ts, level, source, message) VALUES (?,?,?,?,?)"
+# per-connection tuning; NORMAL sync skips the fsync per commit under WAL
+SQLITE_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA cache_size=-20000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",  # 256 MB; pages are read straight from the OS page cache
+)
 
 # -----------------------
 # DB helpers (SQLite)
 # -----------------------
+@st.cache_resource
+def get_conn():
+    # shared writer; BEGIN IMMEDIATE takes the lock up front, WAL lets the read pool run alongside
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False, isolation_level="IMMEDIATE")
+    conn.execute("PRAGMA journal_mode=WAL")
+    for pragma in SQLITE_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+@st.cache_resource
+def get_read_pool():
+    # read-only connections for SELECTs
+    pool = queue.Queue()
+    for _ in range(READ_POOL_SIZE):
+        conn = sqlite3.connect(f"file:{DB_FILE}?mode=ro", uri=True, check_same_thread=False)
+        for pragma in SQLITE_PRAGMAS:
+            conn.execute(pragma)
+        pool.put(conn)
+    return pool
+
+@contextmanager
+def ro_conn():
+    pool = get_read_pool()
+    conn = pool.get()
+    try:
+        yield conn
+    finally:
+        pool.put(conn)
+
+@st.cache_resource
+def get_write_lock():
+    return threading.Lock()
+
+@st.cache_resource
+def get_db_state():
+    # process-wide write counters, one per group of cached readers: "rakes" (rake_events/wagons)
+    # and "history" (assignments/cases/activity_log); readers key on theirs so every session sees new rows
+    return {"rakes": 0, "history": 0}
+
+def db_version(scope="rakes"):
+    return get_db_state()[scope]
+
+@contextmanager
+def db_write(*scopes):
+    # one write transaction on the shared connection, then invalidate the readers of each scope written
+    conn = get_conn()
+    with get_write_lock():
+        with conn:
+            yield conn
+        state = get_db_state()
+        for scope in scopes:
+            state[scope] += 1
+
+def _flush_activity_log(q, conn, lock, state):
+    # drain up to LOG_BATCH_SIZE rows (or whatever arrives within LOG_FLUSH_INTERVAL) per commit;
+    # a None item is the shutdown sentinel: write what came before it, then stop
+    stopping = False
+    while not stopping:
+        rows = [q.get()]
+        deadline = time.monotonic() + LOG_FLUSH_INTERVAL
+        while len(rows) < LOG_BATCH_SIZE and rows[-1] is not None:
+            try:
+                rows.append(q.get(timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                break
+        if rows[-1] is None:
+            stopping = True
+            rows.pop()
+            if not rows:
+                break
+        try:
+            with lock:
+                with conn:
+                    conn.executemany(ACTIVITY_INSERT, rows)
+                state["history"] += 1
+        except sqlite3.Error:
+            traceback.print_exc()
+
+@st.cache_resource
+def get_log_queue():
+    # standalone activity rows are buffered and written in batches by one daemon thread
+    q = queue.Queue()
+    writer = threading.Thread(target=_flush_activity_log, args=(q, get_conn(), get_write_lock(), get_db_state()),
+                              name="activity-log-writer", daemon=True)
+    writer.start()
+    # daemon threads are killed at exit; flush whatever is still queued first
+    atexit.register(_stop_log_writer, q, writer)
+    return q
+
+def _stop_log_writer(q, writer):
+    q.put(None)
+    writer.join(timeout=5)
+
+def _add_column(cur, table, column, decl):
+    # CREATE TABLE IF NOT EXISTS leaves older demo databases on their original columns
+    if column not in {info[1] for info in cur.execute(f"PRAGMA table_info({table})")}:
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+@st.cache_resource
 def init_db():
-    conn = sqlite3.connect(DB_FILE)
+    # schema + migrations for older demo files; runs once per server process
+    conn = get_conn()
     cur = conn.cursor()
     cur.execute("""
       CREATE TABLE IF NOT EXISTS rake_events (
@@ -27,9 +149,28 @@ def init_db():
         current_station TEXT,
         eta_iso TEXT,
         wagon_details TEXT,
-        raw TEXT
+        raw TEXT,
+        eta_epoch INTEGER,
+        wagon_count INTEGER,
+        unloaded_count INTEGER,
+        pending_count INTEGER
       )
     """)
+    _add_column(cur, "rake_events", "eta_epoch", "INTEGER")
+    _add_column(cur, "rake_events", "wagon_count", "INTEGER")
+    _add_column(cur, "rake_events", "unloaded_count", "INTEGER")
+    _add_column(cur, "rake_events", "pending_count", "INTEGER")
+    # sqlite reads the stored ISO strings as UTC, matching iso_to_epoch()
+    cur.execute("UPDATE rake_events SET eta_epoch = CAST(strftime('%s', eta_iso) AS INTEGER) WHERE eta_epoch IS NULL AND eta_iso IS NOT NULL")
+    cur.execute("""
+      CREATE TABLE IF NOT EXISTS wagons (
+        rake_id TEXT,
+        wagon_no TEXT,
+        status TEXT,
+        PRIMARY KEY (rake_id, wagon_no)
+      ) WITHOUT ROWID
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_wagons_rake_status ON wagons(rake_id, status)")
     cur.execute("""
       CREATE TABLE IF NOT EXISTS truck_assignments (
         id TEXT PRIMARY KEY,
@@ -60,98 +201,191 @@ def init_db():
         message TEXT
       )
     """)
+    # the dashboard reads "latest N" from each timeline table; index the ORDER BY columns
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_assign_ts ON truck_assignments(created_ts DESC)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_cases_ts ON cases(reported_ts DESC)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_activity_ts ON activity_log(ts DESC)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_rake_eta_epoch ON rake_events(eta_epoch)")
     conn.commit()
-    conn.close()
-
-def log_activity(level, source, message):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("INSERT INTO activity_log (id, ts, level, source, message) VALUES (?,?,?,?,?)",
-                (str(uuid.uuid4()), datetime.utcnow(), level, source, message))
-    conn.commit()
-    conn.close()
+    # backfill rakes stored before the wagons table / stored counts existed (wagon_details only)
+    legacy = cur.execute("SELECT rake_id, wagon_details FROM rake_events WHERE wagon_count IS NULL").fetchall()
+    if legacy:
+        wagons, summaries = [], []
+        for rid, text in legacy:
+            rows, summary = _wagon_rows(rid, text)
+            wagons.extend(rows)
+            summaries.append((*summary, rid))
+        with db_write("rakes") as conn:
+            conn.executemany("INSERT OR REPLACE INTO wagons (rake_id, wagon_no, status) VALUES (?,?,?)", wagons)
+            conn.executemany("UPDATE rake_events SET wagon_count=?, unloaded_count=?, pending_count=? WHERE rake_id=?", summaries)
+    # rakes written with the wagons table but before the stored counts; fill them from it
+    if cur.execute("SELECT 1 FROM rake_events WHERE unloaded_count IS NULL LIMIT 1").fetchone():
+        with db_write("rakes") as conn:
+            conn.execute("""
+              UPDATE rake_events SET unloaded_count =
+                (SELECT COUNT(*) FROM wagons w WHERE w.rake_id = rake_events.rake_id AND w.status = 'UNLOADED')
+              WHERE unloaded_count IS NULL
+            """)
+            conn.execute("UPDATE rake_events SET pending_count = wagon_count - unloaded_count WHERE pending_count IS NULL")
+    # optimize only refreshes existing stats; seed them with a bounded ANALYZE first
+    with get_write_lock():
+        conn.execute("PRAGMA analysis_limit=400")
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name='sqlite_stat1'").fetchone() is None:
+            conn.execute("ANALYZE")
+        conn.execute("PRAGMA optimize")
+
+def log_activity(level, source, message, conn=None):
+    # message may be a list; each entry becomes its own row. Inside a db_write, pass its conn so the
+    # rows commit with that write; otherwise they go to the batching writer thread
+    ts = datetime.utcnow()
+    rows = [(str(uuid.uuid4()), ts, level, source, msg) for msg in ([message] if isinstance(message, str) else message)]
+    if conn is not None:
+        conn.executemany(ACTIVITY_INSERT, rows)
+        return
+    q = get_log_queue()
+    for row in rows:
+        q.put(row)
+
+def _wagon_rows(rake_id, wagon_details):
+    # wagons-table rows for one rake, plus its (wagon_count, unloaded_count, pending_count) summary;
+    # a wagon listed twice keeps its last status, matching INSERT OR REPLACE, and is counted once
+    latest = {wagon_no: status.upper() for wagon_no, status in parse_wagon_details(wagon_details).itertuples(index=False)}
+    rows = [(rake_id, wagon_no, status) for wagon_no, status in latest.items()]
+    unloaded, pending = count_statuses(latest.values())
+    return rows, (len(rows), unloaded, pending)
 
 def db_insert_rake(rake_id, fnr, current_station, eta_iso, wagon_details, raw=""):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("INSERT OR REPLACE INTO rake_events (rake_id, fnr, created_ts, current_station, eta_iso, wagon_details, raw) VALUES (?,?,?,?,?,?,?)",
-                (rake_id, fnr, datetime.utcnow(), current_station, eta_iso, wagon_details, raw))
-    conn.commit(); conn.close()
-    log_activity("INFO", "FOIS_SIM", f"Inserted/Updated rake {rake_id}")
-
-def db_get_rakes_df():
-    conn = sqlite3.connect(DB_FILE)
-    df = pd.read_sql_query("SELECT * FROM rake_events", conn, parse_dates=["created_ts"])
-    conn.close()
+    db_bulk_insert_rakes([(rake_id, fnr, current_station, eta_iso, wagon_details, raw)])
+
+def db_bulk_insert_rakes(rakes):
+    # rakes: (rake_id, fnr, current_station, eta_iso, wagon_details[, raw]) tuples, written in one transaction;
+    # a rake_id given twice keeps its last tuple, as INSERT OR REPLACE would
+    created_ts = datetime.utcnow()
+    rake_rows, wagons = [], []
+    for rake_id, fnr, current_station, eta_iso, wagon_details, *raw in {rake[0]: rake for rake in rakes}.values():
+        rows, summary = _wagon_rows(rake_id, wagon_details)
+        wagons.extend(rows)
+        rake_rows.append((rake_id, fnr, created_ts, current_station, eta_iso, iso_to_epoch(eta_iso), wagon_details, raw[0] if raw else "", *summary))
+    with db_write("rakes", "history") as conn:
+        conn.executemany("INSERT OR REPLACE INTO rake_events (rake_id, fnr, created_ts, current_station, eta_iso, eta_epoch, wagon_details, raw, wagon_count, unloaded_count, pending_count) VALUES (?,?,?,?,?,?,?,?,?,?,?)",
+                         rake_rows)
+        conn.executemany("DELETE FROM wagons WHERE rake_id=?", [(row[0],) for row in rake_rows])
+        conn.executemany("INSERT OR REPLACE INTO wagons (rake_id, wagon_no, status) VALUES (?,?,?)", wagons)
+        log_activity("INFO", "FOIS_SIM", [f"Inserted/Updated rake {row[0]}" for row in rake_rows], conn=conn)
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False, max_entries=4)
+def _load_rakes_df(version):
+    # counts are stored on the rake row at write time; neither wagon_details nor the wagons table is read
+    with ro_conn() as conn:
+        df = pd.read_sql_query("""
+          SELECT rake_id, fnr, created_ts, current_station, eta_iso, eta_epoch, wagon_count, unloaded_count, pending_count
+          FROM rake_events
+        """, conn, parse_dates=["created_ts"], dtype={"current_station": "category"})
     if df.empty:
         return df
-    # normalize small fields
-    df['pending_count'] = df['wagon_details'].apply(lambda t: sum(1 for p in (t or "").split(";") if ":" in p and p.split(":")[1].strip().upper() != "UNLOADED"))
-    df['unloaded_count'] = df['wagon_details'].apply(lambda t: sum(1 for p in (t or "").split(";") if ":" in p and p.split(":")[1].strip().upper() == "UNLOADED"))
-    df['eta_dt'] = df['eta_iso'].apply(lambda s: parser.isoparse(s) if s else None)
+    df['eta_dt'] = pd.to_datetime(df['eta_epoch'], unit="s", utc=True)
+    # eta_iso strings sqlite's strftime could not read keep a NULL epoch; parse only those rows in pandas
+    missing = df['eta_dt'].isna() & df['eta_iso'].notna()
+    if missing.any():
+        df['eta_dt'] = df['eta_dt'].fillna(pd.to_datetime(df['eta_iso'].where(missing), utc=True, errors="coerce", format="ISO8601"))
     return df
 
-def db_get_rake(rake_id):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM rake_events WHERE rake_id=?", (rake_id,))
-    row = cur.fetchone()
-    conn.close()
-    return row
+def db_get_rakes_df():
+    return _load_rakes_df(db_version())
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False, max_entries=4)
+def _load_rakes_by_pending(version):
+    # sorted once per version, most pending first; the rakes table and every chart reuse this order
+    df = _load_rakes_df(version).sort_values('pending_count', ascending=False).reset_index(drop=True)
+    df['risk'] = compute_d_and_w_risk_array(df['pending_count'])[0]
+    return df
+
+def db_get_rakes_by_pending():
+    return _load_rakes_by_pending(db_version())
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False, max_entries=32)
+def _load_wagons_df(version, rake_id):
+    # a primary-key range read on wagons; wagon_details is only parsed at write time
+    with ro_conn() as conn:
+        return pd.read_sql_query("SELECT wagon_no, status FROM wagons WHERE rake_id=? ORDER BY wagon_no", conn, params=(rake_id,))
+
+def db_get_wagons_df(rake_id):
+    return _load_wagons_df(db_version(), rake_id)
 
 def db_insert_assignment(rake_id, truck_ids, lane_from, reason):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
     task_id = str(uuid.uuid4())
-    cur.execute("INSERT INTO truck_assignments (id, rake_id, truck_ids, lane_from, reason, created_ts) VALUES (?,?,?,?,?,?)",
-                (task_id, rake_id, ",".join(truck_ids), lane_from, reason, datetime.utcnow()))
-    conn.commit(); conn.close()
-    log_activity("INFO", "ASSIGN", f"Assigned {len(truck_ids)} trucks to {rake_id}")
+    with db_write("history") as conn:
+        conn.execute("INSERT INTO truck_assignments (id, rake_id, truck_ids, lane_from, reason, created_ts) VALUES (?,?,?,?,?,?)",
+                     (task_id, rake_id, ",".join(truck_ids), lane_from, reason, datetime.utcnow()))
+        log_activity("INFO", "ASSIGN", f"Assigned {len(truck_ids)} trucks to {rake_id}", conn=conn)
     return task_id
 
-def db_get_assignments_df():
-    conn = sqlite3.connect(DB_FILE)
-    df = pd.read_sql_query("SELECT * FROM truck_assignments ORDER BY created_ts DESC LIMIT 50", conn, parse_dates=["created_ts"])
-    conn.close()
-    return df
-
 def db_insert_case(rake_id, wagon_no, case_type, reported_by, details):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
     case_id = "CASE-" + str(uuid.uuid4())[:8]
-    cur.execute("INSERT INTO cases (case_id, rake_id, wagon_no, case_type, reported_by, reported_ts, details) VALUES (?,?,?,?,?,?,?)",
-                (case_id, rake_id, wagon_no, case_type, reported_by, datetime.utcnow(), details))
-    conn.commit(); conn.close()
-    log_activity("WARN", "CASE", f"{case_type} for {rake_id}:{wagon_no} by {reported_by}")
+    with db_write("history") as conn:
+        conn.execute("INSERT INTO cases (case_id, rake_id, wagon_no, case_type, reported_by, reported_ts, details) VALUES (?,?,?,?,?,?,?)",
+                     (case_id, rake_id, wagon_no, case_type, reported_by, datetime.utcnow(), details))
+        log_activity("WARN", "CASE", f"{case_type} for {rake_id}:{wagon_no} by {reported_by}", conn=conn)
     return case_id
 
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False, max_entries=4)
+def _load_history(version):
+    # assignments, cases and activity for the lower panels, read in one read-only transaction on one
+    # pooled connection so all three show the same snapshot; keyed on the "history" version
+    with ro_conn() as conn:
+        conn.execute("BEGIN DEFERRED")
+        try:
+            assignments = pd.read_sql_query("SELECT * FROM truck_assignments ORDER BY created_ts DESC LIMIT 50", conn, parse_dates=["created_ts"])
+            cases = pd.read_sql_query("SELECT * FROM cases ORDER BY reported_ts DESC LIMIT 100", conn, parse_dates=["reported_ts"],
+                                      dtype={"case_type": "category"})
+            activity = pd.read_sql_query("SELECT * FROM activity_log ORDER BY ts DESC LIMIT 100", conn, parse_dates=["ts"],
+                                         dtype={"level": "category", "source": "category"})
+        finally:
+            conn.rollback()
+    return assignments, cases, activity
+
+def db_get_assignments_df():
+    return _load_history(db_version("history"))[0]
+
 def db_get_cases_df():
-    conn = sqlite3.connect(DB_FILE)
-    df = pd.read_sql_query("SELECT * FROM cases ORDER BY reported_ts DESC LIMIT 100", conn, parse_dates=["reported_ts"])
-    conn.close()
-    return df
+    return _load_history(db_version("history"))[1]
 
 def db_get_activity_df(limit=100):
-    conn = sqlite3.connect(DB_FILE)
-    df = pd.read_sql_query("SELECT * FROM activity_log ORDER BY ts DESC LIMIT ?", conn, params=(limit,), parse_dates=["ts"])
-    conn.close()
-    return df
+    # at most the 100 newest rows are loaded
+    return _load_history(db_version("history"))[2].head(limit)
 
 # -----------------------
 # Domain helpers
 # -----------------------
+# "wagon:status" pairs; status runs to the next ";" (it may itself contain ":")
+_WAGON_RE = re.compile(r"([^;:]*):([^;]*)")
+
 def parse_wagon_details(text):
-    items = []
-    if not text:
-        return items
-    for part in text.split(";"):
-        if ":" in part:
-            wagon, status = part.split(":", 1)
-            items.append({"wagon_no": wagon.strip(), "status": status.strip()})
-    return items
-
-def format_wagon_details(items):
-    return ";".join(f"{w['wagon_no']}:{w['status']}" for w in items)
+    # "W1:PENDING;W2:UNLOADED" -> one row per wagon
+    pairs = _WAGON_RE.findall(text or "")
+    return pd.DataFrame({
+        "wagon_no": [wagon.strip() for wagon, _ in pairs],
+        "status": [status.strip() for _, status in pairs],
+    }, dtype=str)
+
+def count_statuses(statuses):
+    # -> (unloaded, pending)
+    counts = Counter(status.upper() for status in statuses)
+    unloaded = counts["UNLOADED"]
+    return unloaded, sum(counts.values()) - unloaded
+
+def iso_to_epoch(eta_iso):
+    # ETAs are written as naive UTC isoformat strings; anything else is stored with a NULL epoch
+    # and left to the pandas fallback in _load_rakes_df
+    if not eta_iso:
+        return None
+    try:
+        eta_dt = datetime.fromisoformat(eta_iso.replace("Z", "+00:00"))
+    except (ValueError, TypeError, AttributeError):
+        return None
+    if eta_dt.tzinfo is None:
+        eta_dt = eta_dt.replace(tzinfo=timezone.utc)
+    return int(eta_dt.timestamp())
 
 def simple_eta_predict(distance_km, avg_speed_kmph):
     if avg_speed_kmph <= 0: avg_speed_kmph = 20
@@ -165,6 +399,13 @@ def compute_d_and_w_risk(pending_wagons):
         return ("MEDIUM", pending_wagons * 490)
     return ("LOW", 0)
 
+def compute_d_and_w_risk_array(pending):
+    # array form of compute_d_and_w_risk
+    p = np.asarray(pending)
+    risk = np.select([p > 30, p > 10], ["HIGH", "MEDIUM"], "LOW")
+    dem = np.where(p > 30, p * 820, np.where(p > 10, p * 490, 0))
+    return risk, dem
+
 def recommended_actions_for_rake(pending):
     risk, dem = compute_d_and_w_risk(pending)
     actions = []
@@ -177,6 +418,83 @@ def recommended_actions_for_rake(pending):
         actions.append({"action":"monitor","detail":"Continue monitoring", "urgency":"LOW"})
     return actions, risk, dem
 
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False, max_entries=4)
+def kpis(version):
+    # KPI row totals in one aggregate row, recomputed only when a write bumps the db version
+    # the CASE buckets mirror compute_d_and_w_risk
+    with ro_conn() as conn:
+        total_pending, avg_unload_rate, total_dandw, total_rakes = conn.execute("""
+          SELECT COALESCE(SUM(pending_count), 0),
+                 COALESCE(AVG(unloaded_count), 0),
+                 COALESCE(SUM(CASE WHEN pending_count > 30 THEN pending_count * 820
+                                   WHEN pending_count > 10 THEN pending_count * 490
+                                   ELSE 0 END), 0),
+                 COUNT(*)
+          FROM rake_events
+        """).fetchone()
+    return total_pending, avg_unload_rate, total_dandw, total_rakes
+
+# -----------------------
+# Cached figures (Plotly JSON, rebuilt only when the db version changes)
+# -----------------------
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False, max_entries=4)
+def fig_pending_vs_unloaded(version):
+    chart_df = _load_rakes_by_pending(version)[['rake_id','pending_count','unloaded_count']]
+    fig = px.bar(chart_df, x='rake_id', y=['pending_count','unloaded_count'],
+                 labels={'rake_id':'Rake ID', 'pending_count':'Pending', 'unloaded_count':'Unloaded'},
+                 title="Pending vs Unloaded Wagons by Rake",
+                 barmode='group', color_discrete_map={'pending_count':'#ed8936', 'unloaded_count':'#48bb78'})
+    fig.update_layout(height=400)
+    return fig.to_json()
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False, max_entries=4)
+def fig_risk_level(version):
+    display_risk = _load_rakes_by_pending(version)[['rake_id','risk']].copy()
+    display_risk['risk_level'] = display_risk['risk'].map({'HIGH': 1, 'MEDIUM': 2, 'LOW': 3})
+    fig = px.bar(display_risk,
+                 x='rake_id', y='risk_level',
+                 color='risk_level', color_continuous_scale='RdYlGn',
+                 labels={'rake_id':'Rake ID', 'risk_level':'Risk Level'},
+                 title="Risk Level by Rake")
+    fig.update_layout(height=400, showlegend=False)
+    return fig.to_json()
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False, max_entries=4)
+def fig_pending_by_rake(version):
+    # ascending for the horizontal bar: the shared order reversed, no second sort
+    chart_df = _load_rakes_by_pending(version)[['rake_id','pending_count']].iloc[::-1]
+    fig = px.bar(chart_df, y='rake_id', x='pending_count', orientation='h',
+                 labels={'pending_count':'Pending Wagons', 'rake_id':'Rake ID'},
+                 color='pending_count', color_continuous_scale='RdYlGn_r',
+                 title="Pending Wagons by Rake")
+    fig.update_layout(height=400, showlegend=False)
+    return fig.to_json()
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False, max_entries=4)
+def fig_risk_distribution(version):
+    risk_counts = _load_rakes_by_pending(version)['risk'].value_counts()
+    colors_map = {'HIGH': '#ff2e2e', 'MEDIUM': '#ff9000', 'LOW': '#1e7e34'}
+    fig = px.pie(values=risk_counts.values, names=risk_counts.index,
+                 title="Risk Distribution", color=risk_counts.index,
+                 color_discrete_map=colors_map)
+    fig.update_layout(height=400)
+    return fig.to_json()
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False, max_entries=4)
+def fig_eta_timeline(version):
+    display_eta = _load_rakes_df(version)[['rake_id', 'eta_dt']].dropna().sort_values('eta_dt')
+    if display_eta.empty:
+        return None
+    fig = px.scatter(display_eta, x='eta_dt', y='rake_id',
+                     labels={'eta_dt':'Expected Arrival','rake_id':'Rake ID'},
+                     title="ETA Timeline")
+    fig.update_traces(marker=dict(size=12, color='#4299e1'))
+    fig.update_layout(height=400)
+    return fig.to_json()
+
+def show_fig(fig_json):
+    st.plotly_chart(go.Figure(json.loads(fig_json)), use_container_width=True)
+
 # -----------------------
 # UI & Layout
 # -----------------------
@@ -188,7 +506,7 @@ body { font-family: 'Inter', 'Segoe UI', sans-serif; background-color: #f5f7fa;
 .risk-high { color: #ff2e2e; font-weight:700; background: #ffe6e6; padding: 8px 12px; border-radius: 6px; }
 .risk-med { color: #ff9000; font-weight:700; background: #fff4e6; padding: 8px 12px; border-radius: 6px; }
 .risk-low { color: #1e7e34; font-weight:700; background: #e6f7ed; padding: 8px 12px; border-radius: 6px; }
-.kpi-card { 
+div[data-testid="stMetric"] { 
   background: linear-gradient(135deg, #ffffff 0%, #f8f9fa 100%);
   padding: 20px; 
   border-radius: 12px;
@@ -213,15 +531,20 @@ with st.sidebar.expander("Create demo rake (simulate FOIS)"):
     wagons = st.slider("Wagons", 4, 80, 12)
     unloaded_initial = st.slider("Initially unloaded", 0, wagons, 2)
     eta_hours = st.number_input("ETA hours from now", min_value=0.0, max_value=168.0, value=6.0)
+    rake_total = st.number_input("Rakes to create", min_value=1, max_value=100, value=1, step=1)
     if st.button("Create demo rake"):
-        items = [{"wagon_no": f"W{i:03d}", "status": ("UNLOADED" if i <= unloaded_initial else "PENDING")} for i in range(1, wagons+1)]
-        eta_dt = datetime.utcnow() + timedelta(hours=eta_hours)
-        db_insert_rake(rake_id, fnr, station, eta_dt.isoformat(), format_wagon_details(items))
-        st.success(f"Created {rake_id} ({wagons} wagons).")
+        wagon_details = ";".join(f"W{i:03d}:{'UNLOADED' if i <= unloaded_initial else 'PENDING'}" for i in range(1, wagons+1))
+        eta_iso = (datetime.utcnow() + timedelta(hours=eta_hours)).isoformat()
+        # extra rakes get fresh random FNRs; all of them go in with one executemany
+        extra_fnrs = [str(random.randint(10000000,99999999)) for _ in range(rake_total - 1)]
+        db_bulk_insert_rakes([(rake_id, fnr, station, eta_iso, wagon_details)] +
+                             [(f"RAKE-{extra}", extra, station, eta_iso, wagon_details) for extra in extra_fnrs])
+        st.success(f"Created {rake_total} rake(s) ({wagons} wagons each).")
         st.rerun()
 
 st.sidebar.markdown("---")
 if st.sidebar.button("Refresh data"):
+    st.cache_data.clear()
     st.rerun()
 
 # Main header
@@ -230,47 +553,17 @@ st.write("Real-time depot operations dashboard with AI-powered insights & optimi
 
 # KPI row - Enhanced
 rakes_df = db_get_rakes_df()
-total_pending = int(rakes_df['pending_count'].sum()) if not rakes_df.empty else 0
-avg_unload_rate = (rakes_df['unloaded_count'].sum() / max(len(rakes_df),1)) if not rakes_df.empty else 0
-total_dandw = int(sum(compute_d_and_w_risk(int(p))[1] for p in (rakes_df['pending_count'].tolist() if not rakes_df.empty else [])))
-total_rakes = len(rakes_df)
+total_pending, avg_unload_rate, total_dandw, total_rakes = kpis(db_version())
 
 k1, k2, k3, k4 = st.columns(4)
-with k1:
-    st.markdown(f"""
-    <div class='kpi-card'>
-        <div style='color: #718096; font-size: 0.9rem; font-weight: 600;'>PENDING WAGONS</div>
-        <div style='color: #2d3748; font-size: 2.2em; font-weight: 700; margin: 8px 0;'>{total_pending}</div>
-        <div style='color: #a0aec0; font-size: 0.85rem;'>Across {total_rakes} rakes</div>
-    </div>
-    """, unsafe_allow_html=True)
-
-with k2:
-    st.markdown(f"""
-    <div class='kpi-card'>
-        <div style='color: #718096; font-size: 0.9rem; font-weight: 600;'>AVG UNLOAD RATE</div>
-        <div style='color: #48bb78; font-size: 2.2em; font-weight: 700; margin: 8px 0;'>{avg_unload_rate:.1f}</div>
-        <div style='color: #a0aec0; font-size: 0.85rem;'>Per rake</div>
-    </div>
-    """, unsafe_allow_html=True)
-
-with k3:
-    st.markdown(f"""
-    <div class='kpi-card'>
-        <div style='color: #718096; font-size: 0.9rem; font-weight: 600;'>D&W RISK</div>
-        <div style='color: #ed8936; font-size: 2.2em; font-weight: 700; margin: 8px 0;'>₹{total_dandw:,}</div>
-        <div style='color: #a0aec0; font-size: 0.85rem;'>Potential loss</div>
-    </div>
-    """, unsafe_allow_html=True)
-
-with k4:
-    st.markdown(f"""
-    <div class='kpi-card'>
-        <div style='color: #718096; font-size: 0.9rem; font-weight: 600;'>ACTIVE RAKES</div>
-        <div style='color: #4299e1; font-size: 2.2em; font-weight: 700; margin: 8px 0;'>{total_rakes}</div>
-        <div style='color: #a0aec0; font-size: 0.85rem;'>In system</div>
-    </div>
-    """, unsafe_allow_html=True)
+k1.metric("PENDING WAGONS", total_pending)
+k1.caption(f"Across {total_rakes} rakes")
+k2.metric("AVG UNLOAD RATE", f"{avg_unload_rate:.1f}")
+k2.caption("Per rake")
+k3.metric("D&W RISK", f"₹{total_dandw:,}")
+k3.caption("Potential loss")
+k4.metric("ACTIVE RAKES", total_rakes)
+k4.caption("In system")
 
 st.markdown("---")
 
@@ -282,61 +575,44 @@ with left:
         st.info("ℹ️ No rakes in system. Create one from the sidebar.")
     else:
         # prepare display
-        display = rakes_df[['rake_id','fnr','current_station','unloaded_count','pending_count','eta_dt']].copy()
-        display['eta'] = display['eta_dt'].dt.strftime("%Y-%m-%d %H:%M") 
-        display = display.sort_values(by=['pending_count'], ascending=False)
-        # add risk column for coloring
-        display['risk'] = display['pending_count'].apply(lambda p: compute_d_and_w_risk(int(p))[0])
+        ranked = db_get_rakes_by_pending()
+        # risk (for coloring) comes precomputed with the shared order
+        display = ranked[['rake_id','fnr','current_station','unloaded_count','pending_count','eta_dt','risk']].copy()
+        display.insert(display.columns.get_loc('risk'), 'eta', display['eta_dt'].dt.strftime("%Y-%m-%d %H:%M"))
         # show as interactive table with small sparkline: use bar chart to show pending distribution
         st.dataframe(display.rename(columns={
             'rake_id':'Rake ID','fnr':'FNR','current_station':'Station','unloaded_count':'Unloaded','pending_count':'Pending','eta':'ETA','risk':'Risk'
         }).reset_index(drop=True), height=320, use_container_width=True)
 
-        # Visualizations
-        tab1, tab2 = st.tabs(["📈 Pending Distribution", "⏱️ ETA Timeline"])
+        # Visualizations: st.tabs renders every tab body on each rerun, so only the selected view is built
+        chart_view = st.radio("Chart", ["📈 Pending Distribution", "⏱️ ETA Timeline"],
+                              horizontal=True, label_visibility="collapsed", key="rake_chart_view")
         
-        with tab1:
+        if chart_view == "📈 Pending Distribution":
             col1, col2 = st.columns(2)
             with col1:
-                chart_df = display[['rake_id','pending_count']].sort_values('pending_count', ascending=True)
-                fig_bar = px.bar(chart_df, y='rake_id', x='pending_count', orientation='h',
-                                labels={'pending_count':'Pending Wagons', 'rake_id':'Rake ID'}, 
-                                color='pending_count', color_continuous_scale='RdYlGn_r', 
-                                title="Pending Wagons by Rake")
-                fig_bar.update_layout(height=400, showlegend=False)
-                st.plotly_chart(fig_bar, use_container_width=True)
+                show_fig(fig_pending_by_rake(db_version()))
             
             with col2:
-                risk_counts = display['risk'].value_counts()
-                colors_map = {'HIGH': '#ff2e2e', 'MEDIUM': '#ff9000', 'LOW': '#1e7e34'}
-                fig_pie = px.pie(values=risk_counts.values, names=risk_counts.index, 
-                                title="Risk Distribution", color=risk_counts.index,
-                                color_discrete_map=colors_map)
-                fig_pie.update_layout(height=400)
-                st.plotly_chart(fig_pie, use_container_width=True)
+                show_fig(fig_risk_distribution(db_version()))
         
-        with tab2:
-            if not display['eta_dt'].isna().all():
-                display_eta = display[['rake_id', 'eta_dt']].dropna()
-                display_eta = display_eta.sort_values('eta_dt')
-                fig_timeline = px.scatter(display_eta, x='eta_dt', y='rake_id', 
-                                        labels={'eta_dt':'Expected Arrival','rake_id':'Rake ID'},
-                                        title="ETA Timeline")
-                fig_timeline.update_traces(marker=dict(size=12, color='#4299e1'))
-                fig_timeline.update_layout(height=400)
-                st.plotly_chart(fig_timeline, use_container_width=True)
+        else:
+            fig_json = fig_eta_timeline(db_version())
+            if fig_json:
+                show_fig(fig_json)
 
 with right:
     st.markdown("<div class='section-title'>⚡ Quick Actions</div>", unsafe_allow_html=True)
-    sel_rake = st.selectbox("Select Rake", options=(rakes_df['rake_id'].tolist() if not rakes_df.empty else [""]))
+    sel_rake = st.selectbox("Select Rake", options=(rakes_df['rake_id'].tolist() if not rakes_df.empty else [""]), key="rake_select")
     if sel_rake:
         st.markdown(f"### ✅ {sel_rake}")
-        row = db_get_rake(sel_rake)
-        if row:
-            _, fnr, created_ts, station, eta_iso, wagon_details_text, raw = row
-            w_items = parse_wagon_details(wagon_details_text)
-            pending = sum(1 for w in w_items if w['status'].upper() != 'UNLOADED')
-            unloaded = sum(1 for w in w_items if w['status'].upper() == 'UNLOADED')
+        # the selectbox options come from rakes_df, so the row is already loaded
+        rake = rakes_df.loc[rakes_df['rake_id'] == sel_rake]
+        if not rake.empty:
+            rake = rake.iloc[0]
+            fnr, station = rake['fnr'], rake['current_station']
+            unloaded, pending = int(rake['unloaded_count']), int(rake['pending_count'])
+            w_items = db_get_wagons_df(sel_rake)
             
             st.markdown(f"""
             <div class='stat-badge'>📍 {station}</div>
@@ -367,7 +643,7 @@ with right:
                 st.rerun()
 
             with st.expander("⚠️ Create Exception / Case"):
-                wagon_choices = [w['wagon_no'] for w in w_items]
+                wagon_choices = w_items['wagon_no'].tolist()
                 cw = st.selectbox("Wagon", options=wagon_choices, key="wagon_sel")
                 ctype = st.selectbox("Case Type", ["SHORTAGE","DAMAGE","MISSING_WAGON","OTHER"], key="case_type")
                 reporter = st.text_input("Reported by", value="depot_user_01", key="reporter")
@@ -394,14 +670,13 @@ colA, colB, colC = st.columns([1.8,1,1.2])
 with colA:
     if not rakes_df.empty:
         selected = st.selectbox("Choose Rake to inspect", options=rakes_df['rake_id'].tolist(), key="detail_rake")
-        row = db_get_rake(selected)
-        if row:
-            _, fnr, created_ts, station, eta_iso, wagon_text, raw = row
-            items = parse_wagon_details(wagon_text)
-            df_w = pd.DataFrame(items)
+        rake = rakes_df.loc[rakes_df['rake_id'] == selected]
+        if not rake.empty:
+            rake = rake.iloc[0]
+            df_w = db_get_wagons_df(selected)
             # progress
-            unloaded = sum(1 for w in items if w['status'].upper()=="UNLOADED")
-            total = len(items)
+            unloaded, pending = int(rake['unloaded_count']), int(rake['pending_count'])
+            total = unloaded + pending
             pct = int(0 if total==0 else (unloaded/total)*100)
             
             st.markdown(f"""
@@ -411,7 +686,7 @@ with colA:
             
             # Enhanced wagon table with colors
             df_display = df_w.copy()
-            df_display['Status'] = df_display['status'].apply(lambda x: '✓ UNLOADED' if x.upper() == 'UNLOADED' else '⏳ PENDING')
+            df_display['Status'] = np.where(df_display['status'].str.upper() == 'UNLOADED', '✓ UNLOADED', '⏳ PENDING')
             st.dataframe(df_display[['wagon_no','Status']].rename(columns={'wagon_no':'Wagon #'}), 
                         use_container_width=True, height=300)
             
@@ -421,9 +696,9 @@ with colB:
         log_df = db_get_activity_df(20)
         if not log_df.empty:
             recent = log_df.head(5)
-            for _, row in recent.iterrows():
-                level_icon = "🔴" if row['level'] == 'WARN' else "ℹ️"
-                st.write(f"{level_icon} **{row['source']}**: {row['message'][:40]}")
+            for row in recent.itertuples(index=False):
+                level_icon = "🔴" if row.level == 'WARN' else "ℹ️"
+                st.write(f"{level_icon} **{row.source}**: {row.message[:40]}")
         else:
             st.info("No recent activity")
 
@@ -445,25 +720,11 @@ if not rakes_df.empty:
     
     with ana1:
         # Pending vs Unloaded comparison
-        chart_df = rakes_df[['rake_id','pending_count','unloaded_count']].sort_values('pending_count', ascending=False)
-        fig_comp = px.bar(chart_df, x='rake_id', y=['pending_count','unloaded_count'],
-                         labels={'rake_id':'Rake ID', 'pending_count':'Pending', 'unloaded_count':'Unloaded'},
-                         title="Pending vs Unloaded Wagons by Rake",
-                         barmode='group', color_discrete_map={'pending_count':'#ed8936', 'unloaded_count':'#48bb78'})
-        fig_comp.update_layout(height=400)
-        st.plotly_chart(fig_comp, use_container_width=True)
+        show_fig(fig_pending_vs_unloaded(db_version()))
     
     with ana2:
         # Risk heatmap
-        display_risk = rakes_df[['rake_id','pending_count']].copy()
-        display_risk['risk_level'] = display_risk['pending_count'].apply(lambda x: 1 if compute_d_and_w_risk(int(x))[0] == 'HIGH' else (2 if compute_d_and_w_risk(int(x))[0] == 'MEDIUM' else 3))
-        fig_heat = px.bar(display_risk.sort_values('pending_count', ascending=False), 
-                         x='rake_id', y='risk_level',
-                         color='risk_level', color_continuous_scale='RdYlGn',
-                         labels={'rake_id':'Rake ID', 'risk_level':'Risk Level'},
-                         title="Risk Level by Rake")
-        fig_heat.update_layout(height=400, showlegend=False)
-        st.plotly_chart(fig_heat, use_container_width=True)
+        show_fig(fig_risk_level(db_version()))
     
     # Assignment history
     st.markdown("<div style='margin-top: 20px;'></div>", unsafe_allow_html=True)